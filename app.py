@@ -1,108 +1,269 @@
 from fastapi import FastAPI, Request, Query
+from fastapi.responses import ORJSONResponse, Response
 from pymongo import MongoClient
-from collections import defaultdict
+from pymongo.errors import PyMongoError
 from datetime import datetime, timedelta
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from contextlib import asynccontextmanager
 import pandas as pd
-from typing import Optional 
+from typing import Literal, Optional 
+import logging
+import re
+import time
+import uuid
+import orjson
+import redis
 # === CONFIG ===
 BROKER_FEE = 0.03
 SALES_TAX = 0.015
 CACHE_MINUTES = 10000
 HAULING_TIME_MINUTES = 15
+RESULT_LIMIT = 100
+ARBITRAGE_CACHE_SECONDS = 60
+STATION_SEARCH_CACHE_SECONDS = 3600
+STATION_SEARCH_LIMIT = 25
+# Fallback copies outlive the fresh ones but still expire, keys come from user input
+STALE_CACHE_SECONDS = 86400
+FIND_BATCH_SIZE = 5000
+MONGO_POOL_SIZE = 20
+NAME_MEMO_SIZE = 100_000
+REGENERATE_LOCK_SECONDS = 30
+REGENERATE_POLL_SECONDS = 0.05
 
 
+# === Logging Setup ===
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger(__name__)
+
 # === FastAPI Setup ===
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # === MongoDB Setup ===
-client = MongoClient("mongodb://localhost:27017/")
+# One pooled client per process, with wire compression for the order-heavy payloads
+client = MongoClient(
+    "mongodb://localhost:27017/",
+    maxPoolSize=MONGO_POOL_SIZE,
+    compressors="zstd,snappy",
+    retryWrites=True,
+    w="majority",
+)
 db = client["eve_market"]
 orders_col = db["orders"]
 stations_col = db["stations"]
 items_col = db["items"]
 regions_col = db["regions"]
+best_orders_col = db["best_orders"]
+
+# === Redis Setup ===
+# Every key carries a TTL; with maxmemory set, allkeys-lfu also keeps hot keys over cold ones
+cache = redis.Redis()
 
 # === Helper Functions ===
-def get_station_data(station_id):
-    cached = stations_col.find_one({"station_id": station_id})
-    return cached if cached else {"name": str(station_id), "security": 99}
+# Process-local memo of names already found in Mongo. Names don't change
+# between ingests, and unknown IDs are never memoized so they get picked up
+# once fetch_data caches them. Security is not memoized, the arbitrage
+# pipeline reads it live.
+station_name_memo = {}
+item_name_memo = {}
+
+def memoized_lookup(memo, ids, fetch):
+    ids = set(ids)
+    missing = ids - memo.keys()
+    if missing:
+        if len(memo) + len(missing) > NAME_MEMO_SIZE:
+            memo.clear()
+        memo.update(fetch(missing))
+    found = {i: memo.get(i) for i in ids}
+    return {i: v for i, v in found.items() if v is not None}
+
+def get_station_names(station_ids):
+    def fetch(missing):
+        stations = stations_col.find({"station_id": {"$in": list(missing)}}, {"_id": 0, "station_id": 1, "name": 1}).batch_size(FIND_BATCH_SIZE)
+        return {s["station_id"]: s["name"] for s in stations}
+    return memoized_lookup(station_name_memo, station_ids, fetch)
+
+def station_data(station_names, station_id, security):
+    if station_id not in station_names:
+        return {"name": str(station_id), "security": 99}
+    return {"name": station_names[station_id], "security": security}
+
+def security_lookup(local_field, as_field):
+    return {"$lookup": {
+        "from": stations_col.name,
+        "localField": local_field,
+        "foreignField": "station_id",
+        "pipeline": [{"$project": {"_id": 0, "security": 1}}],
+        "as": as_field,
+    }}
+
+def get_item_names(type_ids):
+    def fetch(missing):
+        items = items_col.find({"type_id": {"$in": list(missing)}}, {"_id": 0, "type_id": 1, "name": 1}).batch_size(FIND_BATCH_SIZE)
+        return {i["type_id"]: i["name"] for i in items}
+    return memoized_lookup(item_name_memo, type_ids, fetch)
+
+def store_payload(key, ttl, payload):
+    try:
+        (cache.pipeline()
+            .setex(key, ttl, payload)
+            .setex(f"stale:{key}", STALE_CACHE_SECONDS, payload)
+            .execute())
+    except redis.RedisError as e:
+        logger.warning("Failed to cache %s: %s", key, e)
+
+# Single-flight: only the holder of lock:{key} regenerates, everyone else
+# serves whatever copy exists or waits for the lock to free up. The lock
+# holds a per-caller token so a worker whose lock already expired can't
+# release the next holder's lock.
+release_lock_script = cache.register_script("""
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+""")
+
+def wait_for_regeneration(key, token):
+    while not cache.set(f"lock:{key}", token, nx=True, ex=REGENERATE_LOCK_SECONDS):
+        hit = cache.get(key) or cache.get(f"stale:{key}")
+        if hit is not None:
+            return hit
+        time.sleep(REGENERATE_POLL_SECONDS)
+
+    # The previous holder may have stored a fresh copy right before we won
+    hit = cache.get(key)
+    if hit is not None:
+        release_regeneration_lock(key, token)
+    return hit
+
+def release_regeneration_lock(key, token):
+    try:
+        release_lock_script(keys=[f"lock:{key}"], args=[token])
+    except redis.RedisError as e:
+        logger.warning("Failed to release lock for %s: %s", key, e)
+
+def cached_payload(key, ttl, compute):
+    token = uuid.uuid4().hex
+    try:
+        hit = cache.get(key)
+        if hit is None:
+            hit = wait_for_regeneration(key, token)
+    except redis.RedisError:
+        return orjson.dumps(compute())
+    if hit is not None:
+        return hit
 
-def get_item_name(type_id):
-    cached = items_col.find_one({"type_id": type_id})
-    return cached["name"] if cached else f"Type {type_id}"
+    try:
+        payload = orjson.dumps(compute())
+        store_payload(key, ttl, payload)
+    except PyMongoError:
+        # Fall back to the last result generated within STALE_CACHE_SECONDS
+        stale = cache.get(f"stale:{key}")
+        if stale is None:
+            raise
+        logger.warning("MongoDB unavailable, serving stale %s", key)
+        return stale
+    finally:
+        release_regeneration_lock(key, token)
+    return payload
+
+def cached_result(key, ttl, compute):
+    return orjson.loads(cached_payload(key, ttl, compute))
 
 # === Unified Arbitrage Function === 
-def find_arbitrage(source_station=None, dest_station=None):
+def find_arbitrage(source_station=None, dest_station=None, min_profit=0, min_margin=0.0,
+                   sort_by="total_profit", security_filter=0):
     cutoff = datetime.utcnow() - timedelta(minutes=CACHE_MINUTES)
 
-    sell_orders_query = {"is_buy_order": False, "last_updated": {"$gte": cutoff}}
-    buy_orders_query = {"is_buy_order": True, "last_updated": {"$gte": cutoff}}
+    sell_orders_query = {"is_buy_order": False}
+    buy_orders_query = {"is_buy_order": True}
 
     if source_station:
         sell_orders_query["location_id"] = int(source_station)
     if dest_station:
         buy_orders_query["location_id"] = int(dest_station)
 
+    # best_orders holds one row per (type_id, station, side), reduce it across stations
+    order_fields = {"price": "$price", "volume_remain": "$volume_remain", "location_id": "$location_id"}
+    pipeline = [
+        {"$match": {"last_updated": {"$gte": cutoff}, "$or": [sell_orders_query, buy_orders_query]}},
+        {"$group": {
+            "_id": {"type_id": "$type_id", "is_buy_order": "$is_buy_order"},
+            "lowest": {"$top": {"sortBy": {"price": 1}, "output": order_fields}},
+            "highest": {"$bottom": {"sortBy": {"price": 1}, "output": order_fields}},
+        }},
+        # Pair the best sell with the best buy of each item ($max skips the nulls)
+        {"$group": {
+            "_id": "$_id.type_id",
+            "sell": {"$max": {"$cond": ["$_id.is_buy_order", None, "$lowest"]}},
+            "buy": {"$max": {"$cond": ["$_id.is_buy_order", "$highest", None]}},
+        }},
+        {"$match": {"sell.price": {"$gt": 0}, "buy": {"$ne": None}}},
+        {"$addFields": {
+            "volume": {"$min": ["$sell.volume_remain", "$buy.volume_remain"]},
+            "unit_profit": {"$subtract": [
+                {"$multiply": ["$buy.price", 1 - BROKER_FEE - SALES_TAX]}, "$sell.price",
+            ]},
+        }},
+        {"$addFields": {
+            "total_profit": {"$multiply": ["$unit_profit", "$volume"]},
+            "margin": {"$divide": ["$unit_profit", "$sell.price"]},
+        }},
+        {"$match": {"total_profit": {"$gte": min_profit}, "margin": {"$gte": min_margin}}},
+        {"$addFields": {"isk_per_minute": {"$divide": ["$total_profit", HAULING_TIME_MINUTES]}}},
+    ]
 
-    sell_orders = list(orders_col.find(sell_orders_query))
-    buy_orders = list(orders_col.find(buy_orders_query))
-   
-    sell_by_type = defaultdict(list)
-    buy_by_type = defaultdict(list)
+    if security_filter != 0:
+        pipeline += [
+            security_lookup("sell.location_id", "source"),
+            # Stations missing from the cache count as security 99, same as station_data()
+            {"$match": {"$or": [
+                {"source": {"$size": 0}},
+                {"source.security": {"$gt": security_filter}},
+            ]}},
+        ]
 
-    for o in sell_orders:
-        sell_by_type[o["type_id"]].append(o)
-    for o in buy_orders:
-        buy_by_type[o["type_id"]].append(o)
+    pipeline += [
+        {"$sort": {sort_by: -1, "_id": 1}},
+        {"$limit": RESULT_LIMIT},
+    ]
 
-    
-    results = []
-    common_type_ids = set(sell_by_type.keys()) & set(buy_by_type.keys())
-
-    for type_id in common_type_ids:
-        try:
-            best_sell = min(sell_by_type[type_id], key=lambda x: x["price"])
-            best_buy = max(buy_by_type[type_id], key=lambda x: x["price"])
-
-            sell_price = best_sell["price"]
-            buy_price = best_buy["price"]
-            volume = min(best_sell["volume_remain"], best_buy["volume_remain"])
-
-            proceeds_per_unit = buy_price * (1 - BROKER_FEE - SALES_TAX)
-            unit_profit = proceeds_per_unit - sell_price
-            total_profit = unit_profit * volume
-            margin = unit_profit / sell_price
-            isk_per_minute = total_profit / HAULING_TIME_MINUTES
-
-            
-            results.append({
-                "item": get_item_name(type_id),
-                "source_station": get_station_data(best_sell["location_id"]),
-                "dest_station": get_station_data(best_buy["location_id"]),
-                "buy_price": round(sell_price, 2),
-                "sell_price": round(buy_price, 2),
-                "volume": volume,
-                "unit_profit": round(unit_profit, 2),
-                "total_profit": round(total_profit, 2),
-                "margin": f"{margin:.1%}",
-                "isk_per_minute": round(isk_per_minute, 2),
-            })
-        except Exception as e:
-            print(f"Error processing item {type_id}: {e}")
+    # Security for display comes from the same live lookup the filter uses
+    if security_filter == 0:
+        pipeline.append(security_lookup("sell.location_id", "source"))
+    pipeline += [
+        security_lookup("buy.location_id", "dest"),
+        {"$project": {
+            "_id": 0,
+            "type_id": "$_id",
+            "source_id": "$sell.location_id",
+            "dest_id": "$buy.location_id",
+            "source_security": {"$first": "$source.security"},
+            "dest_security": {"$first": "$dest.security"},
+            "buy_price": {"$round": ["$sell.price", 2]},
+            "sell_price": {"$round": ["$buy.price", 2]},
+            "volume": 1,
+            "unit_profit": {"$round": ["$unit_profit", 2]},
+            "total_profit": {"$round": ["$total_profit", 2]},
+            "margin": 1,
+            "isk_per_minute": {"$round": ["$isk_per_minute", 2]},
+        }},
+    ]
 
-    return results
+    results = list(best_orders_col.aggregate(pipeline))
 
+    # Resolve every name in one round-trip per collection
+    item_names = get_item_names(r["type_id"] for r in results)
+    station_names = get_station_names({r["source_id"] for r in results} | {r["dest_id"] for r in results})
 
-def is_valid_security(security):
-    try:
-        return float(security)
-    except (ValueError, TypeError):
-        return None
+    for r in results:
+        r["item"] = item_names.get(r["type_id"], f"Type {r['type_id']}")
+        r["source_station"] = station_data(station_names, r["source_id"], r.pop("source_security", None))
+        r["dest_station"] = station_data(station_names, r["dest_id"], r.pop("dest_security", None))
+
+    return results
 
 # === API Endpoint: Render Trades ===
 @app.get("/")
@@ -111,32 +272,34 @@ def render_results(request: Request,
                     dest_station: Optional[str] = Query(None),
                     min_profit: int = Query(100000),
                     min_margin: float = Query(0.15),
-                    sort_by: str = Query("total_profit"),
+                    sort_by: Literal["total_profit", "margin", "isk_per_minute"] = Query("total_profit"),
                     security_filter: float = Query(-1.0)):
     
-    results = find_arbitrage(source_station, dest_station)
+    results = cached_result(
+        f"trades:{source_station}:{dest_station}:{min_profit}:{min_margin}:{sort_by}:{security_filter}",
+        ARBITRAGE_CACHE_SECONDS,
+        lambda: find_arbitrage(source_station, dest_station, min_profit, min_margin, sort_by, security_filter),
+    )
 
-    # Apply security level filter
-    if security_filter != 0:
-        filtered_results = []
-        for r in results:
-            sec = is_valid_security(r["source_station"].get("security"))
-            if sec is not None and sec > security_filter:
-                filtered_results.append(r)
-        results = filtered_results
-
-
-    # Apply profit and margin filters
-    results = [r for r in results if r["total_profit"] >= min_profit and float(r["margin"].strip('%'))/100 >= min_margin]
-
-    # Sort results
-    results.sort(key=lambda x: x[sort_by], reverse=True)
-
-    return templates.TemplateResponse("index.html", {"request": request, "trades": results[:100]})
+    return templates.TemplateResponse("index.html", {"request": request, "trades": results})
 
 @app.get("/search_station/")
 def search_station(query: str):
     query = query.lower()
-    stations = list(stations_col.find({"name": {"$regex": query, "$options": "i"}}, {"station_id": 1, "name": 1}))
-    
-    return [{"station_id": s["station_id"], "name": s["name"]} for s in stations]
+
+    def search():
+        projection = {"_id": 0, "station_id": 1, "name": 1}
+        # Anchored prefix regex on the lowercased name can seek the name_lc index
+        stations = list(stations_col.find(
+            {"name_lc": {"$regex": f"^{re.escape(query)}"}}, projection
+        ).sort("name_lc", 1).limit(STATION_SEARCH_LIMIT))
+        if not stations:
+            # Not a prefix of any name, fall back to the best word matches from the text index
+            stations = list(stations_col.find(
+                {"$text": {"$search": query}}, projection
+            ).sort([("score", {"$meta": "textScore"})]).limit(STATION_SEARCH_LIMIT))
+        return stations
+
+    # The cached payload is already JSON, so hand it out without re-encoding
+    payload = cached_payload(f"station_search:{query}", STATION_SEARCH_CACHE_SECONDS, search)
+    return Response(payload, media_type="application/json")
@@ -1,41 +1,172 @@
-import requests
-import time
-from pymongo import MongoClient, ASCENDING, UpdateOne
+import asyncio
+import httpx
+import logging
+from pymongo import MongoClient, ASCENDING, TEXT, UpdateOne
 from datetime import datetime, timedelta
-from tqdm import tqdm
+from tqdm.asyncio import tqdm_asyncio
+import numpy as np
+import pandas as pd
 
 # === CONFIG ===
 CACHE_MINUTES = 30
+# This script runs standalone, so it keeps its own copy of the Mongo settings in app.py
+FIND_BATCH_SIZE = 5000
+MONGO_POOL_SIZE = 20
+ESI_URL = "https://esi.evetech.net/latest"
+ESI_CONCURRENCY = 50
+ESI_MAX_RETRIES = 5
+# Requests already in flight can still fail, so pause while that many errors remain
+ESI_ERROR_LIMIT_FLOOR = ESI_CONCURRENCY
+REGION_CONCURRENCY = 4
+NAMES_CHUNK_SIZE = 1000
+NPC_STATION_IDS = range(60_000_000, 64_000_000)
+ORDER_DTYPE = np.dtype([
+    ("type_id", "i8"),
+    ("location_id", "i8"),
+    ("system_id", "i8"),
+    ("price", "f8"),
+    ("volume_remain", "i8"),
+    ("is_buy_order", "?"),
+])
+ORDER_COLUMNS = list(ORDER_DTYPE.names)
+
+# === Logging Setup ===
+# Per-region progress is logged at DEBUG
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+logger = logging.getLogger(__name__)
 
 # === MongoDB Setup ===
-client = MongoClient("mongodb://localhost:27017/")
+# Same client options as app.py
+client = MongoClient(
+    "mongodb://localhost:27017/",
+    maxPoolSize=MONGO_POOL_SIZE,
+    compressors="zstd,snappy",
+    retryWrites=True,
+    w="majority",
+)
 db = client["eve_market"]
 orders_col = db["orders"]
 stations_col = db["stations"]
 items_col = db["items"]
 regions_col = db["regions"]
+best_orders_col = db["best_orders"]
 
 orders_col.create_index([("order_id", ASCENDING)], unique=True)
 orders_col.create_index([("region_id", ASCENDING), ("last_updated", ASCENDING)])
+best_orders_col.create_index(
+    [("type_id", ASCENDING), ("location_id", ASCENDING), ("is_buy_order", ASCENDING)], unique=True
+)
+best_orders_col.create_index([("region_id", ASCENDING), ("last_updated", ASCENDING)])
+# find_arbitrage reads best_orders now, stop maintaining its old index on every order upsert
+legacy_arbitrage_index = "is_buy_order_1_location_id_1_type_id_1_last_updated_1_price_1_volume_remain_1"
+if legacy_arbitrage_index in orders_col.index_information():
+    orders_col.drop_index(legacy_arbitrage_index)
+# Equality (side, station), then group key, range and the fields find_arbitrage reads
+best_orders_col.create_index([
+    ("is_buy_order", ASCENDING),
+    ("location_id", ASCENDING),
+    ("type_id", ASCENDING),
+    ("last_updated", ASCENDING),
+    ("price", ASCENDING),
+    ("volume_remain", ASCENDING),
+])
 stations_col.create_index("station_id", unique=True)
+stations_col.create_index("name_lc")
+stations_col.create_index([("name", TEXT)])
+# Backfill the lowercased search key for stations cached before it existed
+stations_col.update_many({"name_lc": {"$exists": False}}, [{"$set": {"name_lc": {"$toLower": "$name"}}}])
+# Coerce security values cached before they were stored as doubles
+stations_col.update_many(
+    {"security": {"$type": ["string", "int", "long", "decimal"]}},
+    [{"$set": {"security": {"$convert": {"input": "$security", "to": "double", "onError": None}}}}],
+)
 items_col.create_index("type_id", unique=True)
 regions_col.create_index("region_id", unique=True)
 
-def get_system_security(system_id):
-    url = f"https://esi.evetech.net/latest/universe/systems/{system_id}/"
-    r = requests.get(url)
+# === ESI Client ===
+esi_semaphore = asyncio.Semaphore(ESI_CONCURRENCY)
+# Event loop time until which new requests wait for the ESI error budget to reset
+esi_paused_until = 0.0
+
+def track_error_budget(response):
+    global esi_paused_until
+    remain = response.headers.get("X-ESI-Error-Limit-Remain")
+    reset = response.headers.get("X-ESI-Error-Limit-Reset")
+    if remain is None or reset is None or int(remain) > ESI_ERROR_LIMIT_FLOOR:
+        return
+    resume_at = asyncio.get_running_loop().time() + int(reset)
+    if resume_at > esi_paused_until:
+        logger.warning("ESI error budget down to %s, pausing requests for %ss", remain, reset)
+        esi_paused_until = resume_at
+
+async def wait_for_error_budget():
+    delay = esi_paused_until - asyncio.get_running_loop().time()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+async def esi_request(client, method, path, **kwargs):
+    for attempt in range(ESI_MAX_RETRIES):
+        try:
+            async with esi_semaphore:
+                # Checked at send time, queued requests must see a pause set while they waited
+                await wait_for_error_budget()
+                response = await client.request(method, path, **kwargs)
+        except httpx.TransportError:
+            if attempt == ESI_MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(2 ** attempt)
+            continue
+        track_error_budget(response)
+        # 420 is ESI's error-limit response, 429 the regular rate limit
+        if response.status_code not in (420, 429):
+            return response
+        retry_after = response.headers.get("Retry-After") or response.headers.get("X-ESI-Error-Limit-Reset")
+        await asyncio.sleep(float(retry_after) if retry_after else 2 ** attempt)
+    return response
+
+async def esi_get(client, path, params=None):
+    return await esi_request(client, "GET", path, params=params)
+
+# /universe/names/ resolves up to 1000 IDs per call but rejects the whole
+# call if any ID in it is unknown, so rejected chunks are handed back
+async def resolve_names(client, ids):
+    ids = list(ids)
+    chunks = [ids[i:i + NAMES_CHUNK_SIZE] for i in range(0, len(ids), NAMES_CHUNK_SIZE)]
+    responses = await asyncio.gather(*[
+        esi_request(client, "POST", "/universe/names/", json=chunk) for chunk in chunks
+    ], return_exceptions=True)
+
+    names = {}
+    unresolved = []
+    for chunk, response in zip(chunks, responses):
+        if isinstance(response, httpx.Response) and response.status_code == 200:
+            names.update({entry["id"]: entry["name"] for entry in response.json()})
+        else:
+            unresolved.extend(chunk)
+    return names, unresolved
+
+async def get_system_security(client, system_id):
+    try:
+        r = await esi_get(client, f"/universe/systems/{system_id}/")
+    except httpx.TransportError as e:
+        logger.warning("Failed to fetch system %d: %s", system_id, e)
+        return None
     if r.status_code == 200:
-        data = r.json()
-        return data.get("security_status", None)
+        security = r.json().get("security_status", None)
+        # Stored as a double so the arbitrage query can compare it server-side
+        return float(security) if security is not None else None
     return None
 
-def get_station_info(station_id):
-    cached = stations_col.find_one({"station_id": station_id})
+async def get_station_info(client, station_id):
+    cached = await asyncio.to_thread(stations_col.find_one, {"station_id": station_id})
     if cached:
         return cached["name"], cached.get("security", None)
     
-    url = f"https://esi.evetech.net/latest/universe/stations/{station_id}/"
-    r = requests.get(url)
+    try:
+        r = await esi_get(client, f"/universe/stations/{station_id}/")
+    except httpx.TransportError as e:
+        logger.warning("Failed to fetch station %d: %s", station_id, e)
+        return str(station_id), None
     if r.status_code == 200:
         data = r.json()
         name = data.get("name", str(station_id))
@@ -44,11 +175,12 @@ def get_station_info(station_id):
         # Fetch system security level
         security_level = None
         if system_id:
-            security_level = get_system_security(system_id)
+            security_level = await get_system_security(client, system_id)
         
-        stations_col.update_one(
+        await asyncio.to_thread(
+            stations_col.update_one,
             {"station_id": station_id}, 
-            {"$set": {"name": name, "security": security_level}}, 
+            {"$set": {"name": name, "name_lc": name.lower(), "security": security_level}}, 
             upsert=True
         )
         
@@ -57,62 +189,101 @@ def get_station_info(station_id):
     return str(station_id), None
 
 
-def get_item_name(type_id):
-    cached = items_col.find_one({"type_id": type_id})
+async def get_item_name(client, type_id):
+    cached = await asyncio.to_thread(items_col.find_one, {"type_id": type_id})
     if cached:
         return cached["name"]
-    url = f"https://esi.evetech.net/latest/universe/types/{type_id}/"
-    r = requests.get(url)
+    try:
+        r = await esi_get(client, f"/universe/types/{type_id}/")
+    except httpx.TransportError as e:
+        logger.warning("Failed to fetch type %d: %s", type_id, e)
+        return f"Type {type_id}"
     if r.status_code == 200:
         name = r.json().get("name", f"Type {type_id}")
-        items_col.update_one(
-            {"type_id": type_id}, {"$set": {"name": name}}, upsert=True
+        await asyncio.to_thread(
+            items_col.update_one, {"type_id": type_id}, {"$set": {"name": name}}, upsert=True
         )
         return name
     return f"Type {type_id}"
 
-def get_all_region_ids():
-    url = "https://esi.evetech.net/latest/universe/regions/"
-    response = requests.get(url)
+async def get_all_region_ids(client):
+    response = await esi_get(client, "/universe/regions/")
     response.raise_for_status()
     return response.json()
 
-def get_region_name(region_id):
-    cached = regions_col.find_one({"region_id": region_id})
+async def get_region_name(client, region_id):
+    cached = await asyncio.to_thread(regions_col.find_one, {"region_id": region_id})
     if cached:
         return cached["name"]
-    url = f"https://esi.evetech.net/latest/universe/regions/{region_id}/"
-    r = requests.get(url)
+    try:
+        r = await esi_get(client, f"/universe/regions/{region_id}/")
+    except httpx.TransportError as e:
+        logger.warning("Failed to fetch region %d: %s", region_id, e)
+        return str(region_id)
     if r.status_code == 200:
         name = r.json().get("name", str(region_id))
-        regions_col.update_one(
-            {"region_id": region_id}, {"$set": {"name": name}}, upsert=True
+        await asyncio.to_thread(
+            regions_col.update_one, {"region_id": region_id}, {"$set": {"name": name}}, upsert=True
         )
         return name
     return str(region_id)
 
+async def cache_item_names(client, type_ids):
+    missing = set(type_ids) - set(await asyncio.to_thread(items_col.distinct, "type_id"))
+    names, unresolved = await resolve_names(client, missing)
+    if names:
+        await asyncio.to_thread(items_col.bulk_write, [
+            UpdateOne({"type_id": type_id}, {"$set": {"name": name}}, upsert=True)
+            for type_id, name in names.items()
+        ])
+
+    await tqdm_asyncio.gather(
+        *[get_item_name(client, type_id) for type_id in unresolved], desc="Items", leave=False
+    )
+
+async def cache_stations(client, station_systems):
+    missing = station_systems.keys() - set(await asyncio.to_thread(stations_col.distinct, "station_id"))
+    names, _ = await resolve_names(client, [s for s in missing if s in NPC_STATION_IDS])
+
+    # Names come in bulk, security still needs one lookup per distinct system
+    system_ids = list({station_systems[station_id] for station_id in names})
+    securities = dict(zip(system_ids, await asyncio.gather(*[
+        get_system_security(client, system_id) for system_id in system_ids
+    ])))
+    if names:
+        await asyncio.to_thread(stations_col.bulk_write, [
+            UpdateOne(
+                {"station_id": station_id},
+                {"$set": {"name": name, "name_lc": name.lower(), "security": securities[station_systems[station_id]]}},
+                upsert=True,
+            )
+            for station_id, name in names.items()
+        ])
+
+    # Player structures and IDs the bulk endpoint rejected go one by one
+    await tqdm_asyncio.gather(
+        *[get_station_info(client, station_id) for station_id in missing - names.keys()],
+        desc="Stations", leave=False,
+    )
+
 # === Market order cache ===
+# Streams orders straight into typed columns, without an intermediate list of dicts
+def orders_to_frame(orders, count=-1):
+    rows = (tuple(order[column] for column in ORDER_COLUMNS) for order in orders)
+    return pd.DataFrame(np.fromiter(rows, dtype=ORDER_DTYPE, count=count))
+
 def load_cached_orders(region_id):
     cutoff = datetime.utcnow() - timedelta(minutes=CACHE_MINUTES)
     cursor = orders_col.find({
         "region_id": region_id,
         "last_updated": {"$gte": cutoff}
-    })
-    orders = list(cursor)
-    return orders if orders else None
+    }, {"_id": 0, **{column: 1 for column in ORDER_COLUMNS}}).batch_size(FIND_BATCH_SIZE)
+    orders = orders_to_frame(cursor)
+    return orders if not orders.empty else None
 
 def save_orders_to_cache(region_id, orders):
     now = datetime.utcnow()
     operations = []
-    order_ids = [order["order_id"] for order in orders]
-
-    # Remove outdated orders
-    existing_orders = orders_col.find({"region_id": region_id})
-    existing_order_ids = set(order["order_id"] for order in existing_orders)
-    outdated_order_ids = existing_order_ids - set(order_ids)
-    if outdated_order_ids:
-        result = orders_col.delete_many({"order_id": {"$in": list(outdated_order_ids)}})
-        print(f"❌ Removed {result.deleted_count} outdated orders from cache")
 
     for order in orders:
         order["region_id"] = region_id
@@ -123,68 +294,133 @@ def save_orders_to_cache(region_id, orders):
 
     if operations:
         result = orders_col.bulk_write(operations)
-        print(f"✅ Saved {len(operations)} orders to cache (upserted: {result.upserted_count})")
+        logger.debug("Saved %d orders to cache (upserted: %d)", len(operations), result.upserted_count)
 
-# === Fetch all orders from ESI ===
-def fetch_all_orders(region_id):
-    print(f"Checking cache for region {region_id}...")
-    cached = load_cached_orders(region_id)
-    if cached:
-        print(f"✅ Using cached orders for region {region_id}")
-        return cached
+    # Every order still listed was just stamped with now, anything older is gone from the market
+    result = orders_col.delete_many({"region_id": region_id, "last_updated": {"$lt": now}})
+    if result.deleted_count:
+        logger.debug("Removed %d outdated orders from cache", result.deleted_count)
 
-    print(f"⏳ Fetching live orders for region {region_id} from ESI...")
-    orders = []
-    page = 1
-    while True:
-        url = f"https://esi.evetech.net/latest/markets/{region_id}/orders/"
-        response = requests.get(url, params={"page": page})
-        if response.status_code != 200:
-            print(f"❌ Failed to fetch page {page} for region {region_id}")
-            break
-        batch = response.json()
-        if not batch:
-            break
-        orders.extend(batch)
-        if 'X-Pages' in response.headers:
-            if page >= int(response.headers['X-Pages']):
-                break
-        else:
-            break
-        page += 1
-        time.sleep(0.2)
-    save_orders_to_cache(region_id, orders)
-    return orders
+    refresh_best_orders(region_id, now)
 
-# === Main execution ===
-while True:
-    print("🔍 Fetching all EVE region IDs from ESI...")
+# Materialize the best order per (type_id, station, side) so requests never scan raw orders
+def refresh_best_orders(region_id, now):
+    order_fields = {"price": "$price", "volume_remain": "$volume_remain"}
+    orders_col.aggregate([
+        {"$match": {"region_id": region_id}},
+        {"$group": {
+            "_id": {"type_id": "$type_id", "location_id": "$location_id", "is_buy_order": "$is_buy_order"},
+            "lowest": {"$top": {"sortBy": {"price": 1}, "output": order_fields}},
+            "highest": {"$bottom": {"sortBy": {"price": 1}, "output": order_fields}},
+        }},
+        {"$replaceWith": {"$mergeObjects": [
+            {"$cond": ["$_id.is_buy_order", "$highest", "$lowest"]},
+            {
+                "type_id": "$_id.type_id",
+                "location_id": "$_id.location_id",
+                "is_buy_order": "$_id.is_buy_order",
+                "region_id": region_id,
+                "last_updated": now,
+            },
+        ]}},
+        {"$merge": {
+            "into": best_orders_col.name,
+            "on": ["type_id", "location_id", "is_buy_order"],
+            "whenMatched": "replace",
+            "whenNotMatched": "insert",
+        }},
+    ])
+    best_orders_col.delete_many({"region_id": region_id, "last_updated": {"$lt": now}})
+
+# === Fetch all orders from ESI ===
+async def fetch_orders_page(client, region_id, page):
     try:
-        region_ids = get_all_region_ids()
-    except Exception as e:
-        print(f"❌ Failed to fetch region list: {e}")
-        exit(1)
+        response = await esi_get(client, f"/markets/{region_id}/orders/", params={"page": page})
+    except httpx.TransportError as e:
+        logger.warning("Failed to fetch page %d for region %d: %s", page, region_id, e)
+        return []
+    if response.status_code != 200:
+        logger.warning("Failed to fetch page %d for region %d", page, region_id)
+        return []
+    return response.json()
+
+async def fetch_all_orders(client, region_id):
+    logger.debug("Checking cache for region %d", region_id)
+    cached = await asyncio.to_thread(load_cached_orders, region_id)
+    if cached is not None:
+        logger.debug("Using cached orders for region %d", region_id)
+        # Regions cached before best_orders existed would otherwise show no trades until their next live fetch
+        if await asyncio.to_thread(best_orders_col.find_one, {"region_id": region_id}, {"_id": 1}) is None:
+            await asyncio.to_thread(refresh_best_orders, region_id, datetime.utcnow())
+        return cached
 
-    print(f"📦 Found {len(region_ids)} regions. Starting cache process...")
+    logger.debug("Fetching live orders for region %d from ESI", region_id)
+    response = await esi_get(client, f"/markets/{region_id}/orders/", params={"page": 1})
+    if response.status_code != 200:
+        logger.warning("Failed to fetch page 1 for region %d", region_id)
+        orders = []
+    else:
+        orders = response.json()
+        # The first page reports the page count, the rest are fetched at once
+        pages = int(response.headers.get("X-Pages", 1))
+        batches = await asyncio.gather(*[
+            fetch_orders_page(client, region_id, page) for page in range(2, pages + 1)
+        ])
+        for batch in batches:
+            orders.extend(batch)
+    await asyncio.to_thread(save_orders_to_cache, region_id, orders)
+    return orders_to_frame(orders, count=len(orders))
 
-    for region_id in tqdm(region_ids, desc="Regions"):
-        region_name = get_region_name(region_id)
-        print(f"\n=== Region {region_id}: {region_name} ===")
+# Only a few regions are in flight at once, and each one is reduced to the
+# IDs that still need names before its orders are let go
+region_semaphore = asyncio.Semaphore(REGION_CONCURRENCY)
+
+async def fetch_region(client, region_id):
+    async with region_semaphore:
+        region_name = await get_region_name(client, region_id)
+        logger.debug("Region %d: %s", region_id, region_name)
 
         try:
-            orders = fetch_all_orders(region_id)
+            orders = await fetch_all_orders(client, region_id)
         except Exception as e:
-            print(f"⚠️ Error fetching orders for region {region_id}: {e}")
-            continue
+            logger.warning("Error fetching orders for region %d: %s", region_id, e)
+            return None
+
+        pairs = orders[["location_id", "system_id"]].drop_duplicates()
+        station_systems = dict(zip(pairs["location_id"].tolist(), pairs["system_id"].tolist()))
+        return station_systems, set(orders["type_id"].unique().tolist())
+
+# === Main execution ===
+async def main():
+    limits = httpx.Limits(max_connections=ESI_CONCURRENCY)
+    async with httpx.AsyncClient(base_url=ESI_URL, limits=limits, timeout=30) as client:
+        while True:
+            logger.info("Fetching all EVE region IDs from ESI")
+            try:
+                region_ids = await get_all_region_ids(client)
+            except Exception as e:
+                logger.error("Failed to fetch region list: %s", e)
+                exit(1)
+
+            logger.info("Found %d regions, starting cache process", len(region_ids))
+
+            # Collect IDs across all regions so shared items are only looked up once
+            station_systems = {}
+            unique_types = set()
+            regions = [fetch_region(client, region_id) for region_id in region_ids]
+            for region in tqdm_asyncio.as_completed(regions, desc="Regions"):
+                found = await region
+                if found is None:
+                    continue
+                region_stations, region_types = found
+                station_systems.update(region_stations)
+                unique_types |= region_types
 
-        unique_stations = set(o["location_id"] for o in orders)
-        unique_types = set(o["type_id"] for o in orders)
+            logger.info("Caching %d stations and %d item names", len(station_systems), len(unique_types))
 
-        print(f"🗃️ Caching {len(unique_stations)} stations and {len(unique_types)} item names...")
+            await cache_stations(client, station_systems)
+            await cache_item_names(client, unique_types)
 
-        for station_id in tqdm(unique_stations, desc="Stations", leave=False):
-            station_name, security_level = get_station_info(station_id)
-        for type_id in tqdm(unique_types, desc="Items", leave=False):
-            get_item_name(type_id)
+            logger.info("All regions cached successfully")
 
-    print("✅ All regions cached successfully.")
+asyncio.run(main())